@@ -5,9 +5,12 @@ from cmath import sin
 from pathlib import Path
 from typing import List
 import subprocess
+import atexit
+import shlex
+import socket
 import os
 import sys
-from datetime import datetime
+import functools
 from logger import get_logger
 
 L = get_logger(Path(__file__).name.replace(".py", ""))
@@ -25,10 +28,10 @@ except ModuleNotFoundError:
     subprocess.run(["pip3", "install", "sshconf"], check=True)
     import sshconf
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 
 
-@dataclass
+@dataclass(frozen=True)
 class SallocArgs:
     job_name: str
     time: str
@@ -86,11 +89,11 @@ class SallocArgs:
         )
 
 
-@dataclass
+@dataclass(frozen=True)
 class SingularityArgs:
     singularity_image: str
-    singularity_args: List[str]
-    singularity_env: List[str]
+    singularity_args: List[str] = field(default_factory=list)
+    singularity_env: List[str] = field(default_factory=list)
 
     @staticmethod
     def add_args_to_parser(parser: ArgumentParser):
@@ -120,24 +123,111 @@ class SingularityArgs:
         )
 
 
+# SSH connections to the cluster are multiplexed over a single control socket, so that
+# only the first call pays for the TCP handshake and authentication
+SSH_CONTROL_PATH = "~/.ssh/cm-%r@%h:%p"
+SSH_CONTROL_PERSIST = "10m"
+_ssh_master_checked = set()
+
+
+def _ssh_options() -> List[str]:
+    return [
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        f"ControlPath={SSH_CONTROL_PATH}",
+        "-o",
+        f"ControlPersist={SSH_CONTROL_PERSIST}",
+    ]
+
+
+# Returns True only if this call started the master connection
+def _ensure_ssh_master(cluster="iris") -> bool:
+    host = f"{cluster}-cluster"
+    if host in _ssh_master_checked:
+        return False
+    _ssh_master_checked.add(host)
+    control_path = ["-o", f"ControlPath={SSH_CONTROL_PATH}"]
+    master_alive = (
+        subprocess.run(
+            ["ssh", "-O", "check"] + control_path + [host],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).returncode
+        == 0
+    )
+    if not master_alive:
+        # Start a detached master, later ssh/scp calls reuse its socket
+        started = subprocess.run(
+            ["ssh", "-MNf", "-o", f"ControlPersist={SSH_CONTROL_PERSIST}"]
+            + control_path
+            + [host],
+            check=False,
+        )
+        return started.returncode == 0
+    return False
+
+
+def _ssh_warmup(cluster="iris", keep_connection=False):
+    if on_hpc():
+        return
+    if _ensure_ssh_master(cluster) and not keep_connection:
+        # Close the master we opened when the program exits, even on errors
+        atexit.register(
+            subprocess.run,
+            [
+                "ssh",
+                "-O",
+                "exit",
+                "-o",
+                f"ControlPath={SSH_CONTROL_PATH}",
+                f"{cluster}-cluster",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+
+
+def _ssh_base(cluster="iris", force_tty=False) -> List[str]:
+    _ensure_ssh_master(cluster)
+    tty = ["-t"] if force_tty else []
+    return ["ssh"] + _ssh_options() + tty + [f"{cluster}-cluster"]
+
+
+@functools.lru_cache(maxsize=1)
+def _ssh_config():
+    return sshconf.read_ssh_config(Path.home() / ".ssh" / "config")
+
+
 def exec_output_sync(command: List[str], exec_on_hpc: bool, cluster="iris") -> str:
     if exec_on_hpc and not on_hpc():
-        command = ["ssh", f"{cluster}-cluster"] + command
+        command = _ssh_base(cluster) + command
     bytes = subprocess.check_output(command)
     return bytes.decode("utf-8").strip()
 
 
+@functools.lru_cache(maxsize=None)
 def on_hpc(cluster=None) -> bool:
+    hostname = socket.gethostname()
     if cluster is None:
-        hostname = exec_output_sync(["hostname"], exec_on_hpc=False)
         if "iris-" in hostname or "aion-" in hostname:
             return True
         return False
-    return f"{cluster}-" in exec_output_sync(["hostname"], exec_on_hpc=False)
+    return f"{cluster}-" in hostname
 
 
-def get_hpc_username() -> str:
-    return exec_output_sync(["whoami"], exec_on_hpc=True)
+@functools.lru_cache(maxsize=None)
+def get_hpc_username(cluster="iris") -> str:
+    if not on_hpc():
+        # The login user of the ssh config saves a round-trip to the cluster
+        try:
+            hpc_username = _ssh_config().host(f"{cluster}-cluster").get("user")
+        except OSError:
+            hpc_username = None
+        if hpc_username is not None:
+            return hpc_username
+    return exec_output_sync(["whoami"], exec_on_hpc=True, cluster=cluster)
 
 
 def exec(
@@ -149,102 +239,112 @@ def exec(
     force_tty=False,
     **kwargs,
 ):
-    command = [str(x) for x in command]
+    command = list(map(str, command))
     if exec_on_hpc and not on_hpc():
-        tty = ["-t"] if force_tty else []
-        command = ["ssh"] + tty + [f"{cluster}-cluster"] + command
+        command = _ssh_base(cluster, force_tty=force_tty) + command
     if echo_command:
         print(join_str(command))
     return subprocess.run(command, check=check, **kwargs)
 
 
+def hpc_shell_arg(arg: str) -> str:
+    # Commands prefixed with ssh are parsed again by the remote shell, so an argument
+    # that must stay a single word (eg. a `bash -c` script) is quoted in that case
+    return arg if on_hpc() else shlex.quote(arg)
+
+
 def copy_to_hpc(path: Path, hpc_destination_path: Path, cluster="iris"):
     if on_hpc(cluster):
         exec(
             ["/bin/cp", "-fR", str(path), str(hpc_destination_path)], exec_on_hpc=False
         )
     else:
+        # rsync only sends changed blocks, compressed, over the multiplexed ssh channel
+        _ensure_ssh_master(cluster)
         exec(
-            ["scp", path, f"{cluster}-cluster:{hpc_destination_path}"],
+            [
+                "rsync",
+                "-az",
+                "--inplace",
+                "-e",
+                join_str(["ssh"] + _ssh_options()),
+                path,
+                f"{cluster}-cluster:{hpc_destination_path}",
+            ],
             exec_on_hpc=False,
         )
 
 
 def join_str(l: List, x: str = " "):
-    return x.join([str(x) for x in l])
+    return x.join(map(str, l))
 
 
 def prepare_slurm_and_singularity_args(
     salloc: SallocArgs, singularity: SingularityArgs
 ):
+    # Each --slurm-arg can hold several words (eg. '--qos normal')
+    slurm_args = [word for arg in salloc.slurm_args for word in shlex.split(arg)]
     alloc_args = [
         f"-c",
-        salloc.cpus,
+        str(salloc.cpus),
         f"--time={salloc.time}",
         f"--mem={salloc.mem}",
         "-J",
         salloc.job_name,
-    ] + salloc.slurm_args
+    ] + slurm_args
     if salloc.gpus > 0:
         gpu_capability = "gpu,volta32" if salloc.volta32 else "gpu"
-        alloc_args += ["-p", "gpu", "-G", salloc.gpus, "-C", gpu_capability]
-    singularity_args = singularity.singularity_args
-    if args.gpus > 0 and "--nv" not in singularity_args:
+        alloc_args += ["-p", "gpu", "-G", str(salloc.gpus), "-C", gpu_capability]
+    # Copy so that the flags added here are not appended to the dataclass list
+    singularity_args = list(singularity.singularity_args)
+    if salloc.gpus > 0 and "--nv" not in singularity_args:
         singularity_args += ["--nv"]
-    if len(args.singularity_env) > 0:
+    if len(singularity.singularity_env) > 0:
         singularity_args += [
             f"--env {env_var}" for env_var in singularity.singularity_env
         ]
     return alloc_args, singularity_args
 
 
-def scratch_path():
-    username = get_hpc_username()
+@functools.lru_cache(maxsize=None)
+def scratch_path(cluster="iris"):
+    username = get_hpc_username(cluster)
     return Path(f"/scratch/users/{username}")
 
 
-def tools_path():
-    return scratch_path() / Path(__file__).name.replace(".py", "")
-
-
-def copy_to_tools_folder(path: Path, name: str, cluster="iris"):
-    folder = tools_path()
-    exec(["mkdir", "-p", str(folder)], exec_on_hpc=True, cluster=cluster)
-    copy_to_hpc(path, folder / name, cluster=cluster)
-    return folder / name
+@functools.lru_cache(maxsize=None)
+def tools_path(cluster="iris"):
+    return scratch_path(cluster) / Path(__file__).name.replace(".py", "")
 
 
-def get_allocated_node_by_jobname(job_name: str, cluster="iris"):
-    allocated_nodes = exec_output_sync(
-        ["squeue", "--me", "-h", f'--name="{job_name}"', "-o", '"%i %R"'],
+def write_script_to_hpc(content: str, hpc_destination_path: Path, cluster="iris"):
+    # Small scripts are piped through ssh stdin, creating the folder in the same call
+    # The script is made executable, like the local copy an upload would preserve
+    folder = shlex.quote(str(hpc_destination_path.parent))
+    destination = shlex.quote(str(hpc_destination_path))
+    script = f"mkdir -p {folder} && cat > {destination} && chmod +x {destination}"
+    exec(
+        ["bash", "-c", hpc_shell_arg(script)],
         exec_on_hpc=True,
         cluster=cluster,
-    ).split("\n")
-    if len(allocated_nodes) > 1:
-        L.warning(
-            f"Detected several allocations with name '{job_name}'. You probably want to kill some of them to avoid wasting resources. Use `squeue --me` on iris-cluster to decide which allocations to use `scancel` on"
-        )
-    [job_id, node_name] = allocated_nodes[0].split(" ")
-    return [job_id, node_name]
+        input=content,
+        text=True,
+    )
 
 
-def copy_vscode_attach_script_to_tools(
-    job_name: str, arguments: List[str], cluster="iris"
-):
-    # Copy the template and then replace the arguments placeholder with the values
+def copy_to_tools_folder(path: Path, name: str, cluster="iris"):
+    folder = tools_path(cluster)
+    write_script_to_hpc(path.read_text(), folder / name, cluster=cluster)
+    return folder / name
+
+
+def render_vscode_attach_script(arguments: List[str]) -> str:
+    # Read the template and then replace the arguments placeholder with the values
     template = (
         Path(__file__).parent.absolute() / "scripts" / "vscode_attach.template.sh"
     ).read_text()
     arguments = join_str(arguments).strip()
-    template = template.replace("[ARGUMENTS]", arguments)
-    unique_timestamp = int(datetime.now().timestamp())
-    tmp_file = Path(f"/tmp/singularity_vscode_attach_{unique_timestamp}.sh")
-    tmp_file.write_text(template)
-    path = copy_to_tools_folder(
-        tmp_file, f"vscode_attach_{job_name}.sh", cluster=cluster
-    )
-    tmp_file.unlink()
-    return path
+    return template.replace("[ARGUMENTS]", arguments)
 
 
 def run_singularity_job(
@@ -258,7 +358,8 @@ def run_singularity_job(
     alloc_args, singularity_args = prepare_slurm_and_singularity_args(
         salloc, singularity
     )
-    singularity_args += ["--bind", f"{scratch_path()}:{scratch_path()}"]
+    scratch = scratch_path(cluster)
+    singularity_args += ["--bind", f"{scratch}:{scratch}"]
     script_command = [command] + command_args
     local_run_script_path = (
         Path(__file__).parent.absolute() / "scripts" / "singularity_exec.sh"
@@ -274,7 +375,7 @@ def run_singularity_job(
     ]
     if batch:
         # Schedule job with sbatch
-        batch_args = ["-N", 1, "--output=%x-%j.out"]
+        batch_args = ["-N", "1", "--output=%x-%j.out"]
         exec(
             ["sbatch"] + batch_args + alloc_args + run_command,
             exec_on_hpc=True,
@@ -284,6 +385,25 @@ def run_singularity_job(
         exec(["srun"] + alloc_args + run_command, exec_on_hpc=True, cluster=cluster)
 
 
+# Check that SSH is probably configured on local machine, without connecting to the cluster
+@functools.lru_cache(maxsize=None)
+def get_ssh_identity_file(cluster="iris") -> str:
+    ssh_identity_file = _ssh_config().host(f"{cluster}-cluster").get("identityfile")
+    if ssh_identity_file is None:
+        die(
+            f"Could not read IdentityFile in your ssh config. Check the README for instructions on how to setup your iris-cluster host in SSH config."
+        )
+    L.info(f"Will use SSH identity {ssh_identity_file}")
+    return ssh_identity_file
+
+
+# Exit codes of the batched attach shell, ssh itself returns 255 on connection errors
+IMAGE_NOT_FOUND_EXIT_CODE = 3
+ALLOCATION_FAILED_EXIT_CODE = 4
+SSH_ERROR_EXIT_CODE = 255
+ALLOCATION_WAIT_TIMEOUT = "10m"
+
+
 def setup_for_vscode_attach(
     salloc: SallocArgs, singularity: SingularityArgs, cluster="iris"
 ):
@@ -291,51 +411,86 @@ def setup_for_vscode_attach(
         die(
             "Error: the vscode attach script should be run on your local machine, not on the cluster"
         )
-    # Check that singularity image exists on iris, otherwise attach will fail later on
-    try:
-        exec(
-            ["ls", singularity.singularity_image],
-            exec_on_hpc=True,
-            cluster=cluster,
-            check=True,
-            echo_command=True,
-        )
-    except:
-        die(
-            f"Error: File {singularity.singularity_image} not found on {cluster} cluster. If the path looks right, check that you can connect to {cluster} by running `ssh {cluster}-cluster`."
-        )
 
-    # Check that SSH is probably configured on local machine
-    ssh_config = sshconf.read_ssh_config(Path.home() / ".ssh" / "config")
-    ssh_identity_file = ssh_config.host(f"{cluster}-cluster").get("identityfile")
-    if ssh_identity_file is None:
-        die(
-            f"Could not read IdentityFile in your ssh config. Check the README for instructions on how to setup your iris-cluster host in SSH config."
-        )
-    L.info(f"Will use SSH identity {ssh_identity_file}")
+    ssh_config = _ssh_config()
+    ssh_identity_file = get_ssh_identity_file(cluster)
 
     alloc_args, singularity_args = prepare_slurm_and_singularity_args(
         salloc, singularity
     )
-    scratch = scratch_path()
+    scratch = scratch_path(cluster)
     singularity_args += ["--bind", f"{scratch}:{scratch}"]
-    vscode_attach_script_path = copy_vscode_attach_script_to_tools(
-        salloc.job_name,
-        singularity_args + [singularity.singularity_image],
-        cluster=cluster,
+    vscode_attach_script = render_vscode_attach_script(
+        singularity_args + [singularity.singularity_image]
+    )
+    vscode_attach_script_path = (
+        tools_path(cluster) / f"vscode_attach_{salloc.job_name}.sh"
     )
 
+    # Check the image, upload the attach script, allocate and find the allocated node
+    # in a single remote shell rather than one ssh call per step
     # TODO use srun inside the vscode-attach script directly, alloc is not needed!
-    # TODO Adjust SSH config automagically
-    exec(["salloc", "--no-shell"] + alloc_args, exec_on_hpc=True, cluster=cluster)
-
-    # Find allocated nodeget_allocated_node_by_jobname
-    [job_id, allocated_node] = get_allocated_node_by_jobname(salloc.job_name, cluster)
+    job_name = shlex.quote(salloc.job_name)
+    remote_script = f"""set -e
+ls {shlex.quote(singularity.singularity_image)} > /dev/null || exit {IMAGE_NOT_FOUND_EXIT_CODE}
+mkdir -p {shlex.quote(str(vscode_attach_script_path.parent))}
+cat > {shlex.quote(str(vscode_attach_script_path))} <<'VSCODE_ATTACH_EOF'
+{vscode_attach_script}
+VSCODE_ATTACH_EOF
+salloc --no-shell {join_str(map(shlex.quote, alloc_args))}
+job_ids=$(squeue --me -h --name={job_name} -o '%i')
+[ -n "$job_ids" ] || exit {ALLOCATION_FAILED_EXIT_CODE}
+echo "$job_ids" | wc -l
+# A single iterating squeue reports the job until it is RUNNING, instead of polling
+timeout {ALLOCATION_WAIT_TIMEOUT} stdbuf -oL squeue -h -i 2 -t all -j "$(echo "$job_ids" | head -n 1)" -o '%i %T %R' | {{
+    while read -r job_id state node; do
+        case "$state" in
+            RUNNING) echo "$job_id $node"; exit 0 ;;
+            PENDING|CONFIGURING|REQUEUED|RESIZING) ;;
+            *) echo "Job $job_id is $state" >&2; exit {ALLOCATION_FAILED_EXIT_CODE} ;;
+        esac
+    done
+    # squeue stopped (job gone or timeout) before the job was RUNNING
+    exit {ALLOCATION_FAILED_EXIT_CODE}
+}}
+"""
+    result = exec(
+        ["bash", "-s"],
+        exec_on_hpc=True,
+        cluster=cluster,
+        check=False,
+        input=remote_script,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    if result.returncode == IMAGE_NOT_FOUND_EXIT_CODE:
+        die(
+            f"Error: File {singularity.singularity_image} not found on {cluster} cluster. If the path looks right, check that you can connect to {cluster} by running `ssh {cluster}-cluster`."
+        )
+    elif result.returncode == ALLOCATION_FAILED_EXIT_CODE:
+        die(
+            f"Error: Allocation '{salloc.job_name}' did not reach the RUNNING state on {cluster} cluster (ended, or still pending after {ALLOCATION_WAIT_TIMEOUT}). Check it with `squeue --me --states=all`."
+        )
+    elif result.returncode == SSH_ERROR_EXIT_CODE:
+        die(
+            f"Error: Could not run the setup on {cluster} cluster. Check that you can connect to {cluster} by running `ssh {cluster}-cluster`."
+        )
+    elif result.returncode != 0:
+        die(
+            f"Error: Setup failed on {cluster} cluster (exit code {result.returncode}), see the output above."
+        )
+    # The script prints the number of allocations with this name, then the running one
+    [allocation_count, allocated_job] = result.stdout.strip().split("\n")[-2:]
+    if int(allocation_count) > 1:
+        L.warning(
+            f"Detected several allocations with name '{salloc.job_name}'. You probably want to kill some of them to avoid wasting resources. Use `squeue --me` on iris-cluster to decide which allocations to use `scancel` on"
+        )
+    [job_id, allocated_node] = allocated_job.split(" ")
     L.info(f"Successful allocation on {allocated_node}")
 
     # Update local SSH settings for easy vscode attach
     ssh_host = f"{salloc.job_name}-vscode"
-    hpc_username = exec_output_sync(["whoami"], exec_on_hpc=True, cluster=cluster)
+    hpc_username = get_hpc_username(cluster)
     remote_command = (
         f"srun --jobid {job_id} --overlap bash -i {vscode_attach_script_path}"
     )
@@ -364,15 +519,15 @@ def setup_for_vscode_attach(
 def convert_docker_to_sif(tag: str, source: str, sif_path: Path):
     tag_nospace = tag.replace("/", "-").replace(":", "-").replace(" ", "-")
 
-    def alloc_convert_node():
-        L.info(f"Allocating node to convert image to SIF file")
-        job_name = f"docker-conversion-{tag_nospace}"
+    def build_on_convert_node(build_source: str):
+        # srun blocks until resources are available and releases them once the build exits
+        # With a tty, interrupting locally also stops srun and frees the allocation
         exec(
             [
-                "salloc",
-                "--no-shell",
+                "srun",
+                "--pty",
                 "-J",
-                job_name,
+                f"docker-conversion-{tag_nospace}",
                 "-p",
                 "interactive",
                 "--qos",
@@ -383,86 +538,74 @@ def convert_docker_to_sif(tag: str, source: str, sif_path: Path):
                 "4",
                 "-t",
                 "01:00:00",
+                "bash",
+                "-l",
+                "-c",
+                hpc_shell_arg(
+                    f"module load tools/Singularity && singularity build {sif_path} {build_source}"
+                ),
             ],
             exec_on_hpc=True,
+            force_tty=True,
         )
-        return get_allocated_node_by_jobname(job_name)
 
     assert source in ["local", "registry"], f"Invalid source '{source}'"
     if source == "local":
-        # If local: export local image to tar file, upload to HPC, and convert to singularity
-        # But if the tag is not a tag but actually a path to a tar file, just use that
+        # If local: stream the exported image to HPC, and convert to singularity
+        # But if the tag is not a tag but actually a path to a tar file, just upload that
         if tag.endswith("tar") and Path(tag).exists():
             tar_image_path = Path(tag)
+            remote_tar_image_path = sif_path.parent / tar_image_path.name
+            L.info(f"Uploading {tar_image_path} to HPC path {remote_tar_image_path}")
+            copy_to_hpc(tar_image_path, remote_tar_image_path)
         else:
-            tar_image_path: Path = Path("/tmp") / f"{tag_nospace}.tar"
-            L.info(f"Exporting {tag} to {tar_image_path} on your local machine")
-            if tar_image_path.exists():
-                L.info(
-                    f"{tar_image_path} already exists, reusing it. If you wish to export the image again, delete this file."
-                )
-            else:
+            tar_image_path = Path(f"{tag_nospace}.tar")
+            remote_tar_image_path = sif_path.parent / tar_image_path.name
+            L.info(f"Exporting {tag} to HPC path {remote_tar_image_path}")
+            # Pipe docker save straight into the remote file instead of staging it locally
+            save_command = ["docker", "save", tag]
+            upload_command = _ssh_base() + [
+                f"cat > {shlex.quote(str(remote_tar_image_path))}"
+            ]
+            print(f"{join_str(save_command)} | {join_str(upload_command)}")
+            docker_save = subprocess.Popen(save_command, stdout=subprocess.PIPE)
+            upload = subprocess.Popen(upload_command, stdin=docker_save.stdout)
+            docker_save.stdout.close()
+            upload.wait()
+            if docker_save.wait() != 0 or upload.returncode != 0:
+                # Do not leave an empty or partial tar behind next to the SIF file
                 exec(
-                    ["docker", "save", "-o", str(tar_image_path), tag],
-                    exec_on_hpc=False,
+                    ["rm", "-f", remote_tar_image_path],
+                    exec_on_hpc=True,
+                    check=False,
+                    echo_command=False,
                 )
-        remote_tar_image_path = sif_path.parent / tar_image_path.name
-        L.info(f"Uploading {tar_image_path} to HPC path {remote_tar_image_path}")
-        exec(
-            ["scp", str(tar_image_path), f"iris-cluster:{remote_tar_image_path}"],
-            exec_on_hpc=False,
-            echo_command=False,
-        )
-        job_id, allocated_node = alloc_convert_node()
-        L.info(f"Converting {tar_image_path} to SIF file at {sif_path}")
-        exec(
-            [
-                "ssh",
-                "-J",
-                "iris-cluster",
-                "-o",
-                "StrictHostKeyChecking=no",
-                allocated_node,
-                "bash",
-                "-l",
-                "-c",
-                f'"module load tools/Singularity && singularity build {sif_path} docker-archive://{remote_tar_image_path}"',
-            ],
-            exec_on_hpc=False,
-        )
-        L.info(f"Removing tmp files {tar_image_path} and iris-cluster:{tar_image_path}")
-        exec(["rm", tar_image_path], exec_on_hpc=False, echo_command=False)
-        exec(["rm", remote_tar_image_path], exec_on_hpc=True, echo_command=False)
+                die(f"Error: Could not export {tag} to {remote_tar_image_path}")
+        L.info(f"Converting {remote_tar_image_path} to SIF file at {sif_path}")
+        try:
+            build_on_convert_node(f"docker-archive://{remote_tar_image_path}")
+        finally:
+            # Also remove the tar when the build fails or is interrupted
+            L.info(f"Removing tmp file iris-cluster:{remote_tar_image_path}")
+            exec(
+                ["rm", "-f", remote_tar_image_path],
+                exec_on_hpc=True,
+                check=False,
+                echo_command=False,
+            )
     else:
-        job_id, allocated_node = alloc_convert_node()
         L.info(f"Converting {tag} to SIF file at {sif_path}")
-        exec(
-            [
-                "ssh",
-                "-J",
-                "iris-cluster",
-                "-o",
-                "StrictHostKeyChecking=no",
-                allocated_node,
-                "bash",
-                "-l",
-                "-c",
-                f'"module load tools/Singularity && singularity build {sif_path} docker://{tag}"',
-            ],
-            exec_on_hpc=False,
-        )
-    L.info(f"Releasing allocated resources")
-    exec(
-        ["scancel", f"--name={job_id}"],
-        check=False,
-        exec_on_hpc=True,
-        echo_command=False,
-    )
+        build_on_convert_node(f"docker://{tag}")
     L.info(f"All done!")
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
+    parser.add_argument(
+        "--keep-connection",
+        action="store_true",
+        help=f"If specified, the SSH connection to the cluster is kept open for {SSH_CONTROL_PERSIST} after exiting so that later invocations can reuse it.",
+    )
     subparsers = parser.add_subparsers(dest="subparser")
 
     # docker-convert subcommand: used to create a SIF image from a local docker tag, or from a tag from an online registry
@@ -524,12 +667,18 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     if args.subparser == "docker-convert":
+        _ssh_warmup("iris", args.keep_connection)
         convert_docker_to_sif(args.tag, args.source, args.sif_path)
     elif args.subparser in ["attach-vscode", "run"]:
         salloc = SallocArgs.from_args(args)
-        salloc.job_name = salloc.job_name.replace(" ", "_")
+        salloc = replace(salloc, job_name=salloc.job_name.replace(" ", "_"))
         singularity = SingularityArgs.from_args(args)
-        cluster = args.cluster
+        # Only attach-vscode has a --cluster option, run targets iris
+        cluster = getattr(args, "cluster", "iris")
+        if args.subparser == "attach-vscode" and not on_hpc():
+            # Fail locally on a missing SSH identity before connecting to the cluster
+            get_ssh_identity_file(cluster)
+        _ssh_warmup(cluster, args.keep_connection)
         if args.subparser == "attach-vscode":
             setup_for_vscode_attach(salloc, singularity, cluster)
         elif args.subparser == "run":